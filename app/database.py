@@ -3,6 +3,7 @@
 import logging
 import os
 from datetime import datetime, date, time
+from time import monotonic
 from typing import Any, Dict, List, Optional
 
 import psycopg
@@ -16,6 +17,9 @@ from config import (
 
 logger = logging.getLogger(__name__)
 
+# Сколько секунд значение настройки живет в кэше get_setting_cached
+SETTINGS_CACHE_TTL = 60
+
 # --- НОВЫЙ УНИВЕРСАЛЬНЫЙ БЛОК ДЛЯ ПОДКЛЮЧЕНИЯ К БД ---
 # Проверяем, есть ли переменная DATABASE_URL (стандарт для Render.com)
 if database_url := os.environ.get("DATABASE_URL"):
@@ -36,6 +40,8 @@ class Database:
     def __init__(self, conninfo: str):
         self.conninfo = conninfo
         self.pool: Optional[AsyncConnectionPool] = None
+        # key -> (время загрузки, значение или None, если настройки нет)
+        self._settings_cache: Dict[str, tuple[float, Optional[str]]] = {}
 
     async def initialize(self):
         """Инициализирует пул соединений и структуру базы данных."""
@@ -107,6 +113,8 @@ class Database:
                         FOREIGN KEY (activity_id) REFERENCES activities(id) ON DELETE CASCADE
                     )
                 """)
+                # Выборка подписчиков активности идет по activity_id — первичный ключ (user_id, activity_id) тут не помогает
+                await cur.execute("CREATE INDEX IF NOT EXISTS idx_us_activity_user ON user_subscriptions (activity_id, user_id)")
                 await cur.execute("""
                     CREATE TABLE IF NOT EXISTS transactions (
                         id SERIAL PRIMARY KEY,
@@ -116,16 +124,38 @@ class Database:
                         type TEXT NOT NULL,
                         comment TEXT,
                         created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                        external_id TEXT UNIQUE,
                         FOREIGN KEY (from_user_id) REFERENCES users(id),
                         FOREIGN KEY (to_user_id) REFERENCES users(id)
                     )
                 """)
+                # ID платежа у внешнего провайдера (Tribute) — защита от повторного зачисления при ретраях вебхука.
+                # Для баз, созданных до появления колонки
+                await cur.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS external_id TEXT UNIQUE")
+                # Частичный индекс для проверки «демерредж за сегодня уже списан» в пакетном демерредже
+                await cur.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_transactions_demurrage_from_user
+                    ON transactions (from_user_id, created_at) WHERE type = 'demurrage'
+                """)
                 await cur.execute("""
                     CREATE TABLE IF NOT EXISTS settings (
                         key TEXT PRIMARY KEY,
                         value TEXT NOT NULL
                     )
                 """)
+                # Участники активности: для «Общих событий» (id = 1) — все пользователи, для остальных — подписчики.
+                # Подписки на активность 1 во второй ветке исключены, чтобы не было дублей
+                await cur.execute("""
+                    CREATE OR REPLACE VIEW v_activity_members AS
+                    SELECT u.id AS user_id, u.telegram_id, 1 AS activity_id
+                    FROM users u
+                    WHERE u.telegram_id != 0
+                    UNION ALL
+                    SELECT us.user_id, u.telegram_id, us.activity_id
+                    FROM user_subscriptions us
+                    JOIN users u ON u.id = us.user_id
+                    WHERE us.activity_id != 1
+                """)
 
                 # Системные записи
                 await cur.execute("""
@@ -228,12 +258,26 @@ class Database:
                 result = await cur.fetchone()
                 return result[0] if result else default
 
+    async def get_setting_cached(self, key: str, default: Optional[str] = None, ttl: float = SETTINGS_CACHE_TTL) -> Optional[str]:
+        """
+        То же, что get_setting, но с кэшем в памяти процесса на ttl секунд.
+        Для редко меняющихся настроек, которые читаются в фоновых задачах.
+        """
+        cached = self._settings_cache.get(key)
+        if cached is not None and monotonic() - cached[0] < ttl:
+            value = cached[1]
+        else:
+            value = await self.get_setting(key)
+            self._settings_cache[key] = (monotonic(), value)
+        return value if value is not None else default
+
     async def set_setting(self, key: str, value: str):
         async with self.pool.connection() as conn:
             await conn.execute(
                 "INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
                 (key, value)
             )
+        self._settings_cache.pop(key, None)
 
     async def handle_debt_repayment(self, user_id: int):
         async with self.pool.connection() as conn:
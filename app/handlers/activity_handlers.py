@@ -31,9 +31,9 @@ async def cmd_activity(message: Message):
         await message.answer("На данный момент нет ни одной доступной активности.")
         return
         
-    user_subscriptions = await db.get_user_subscriptions(user_id)
+    user_sub_ids = frozenset(sub['activity_id'] for sub in await db.get_user_subscriptions(user_id))
     
-    keyboard = await get_activities_keyboard(activities_to_show, user_subscriptions)
+    keyboard = get_activities_keyboard(activities_to_show, user_sub_ids)
     
     explanation_text = (
         "«Активность» — это направление деятельности или «кружок по интересам», "
@@ -54,7 +54,7 @@ async def process_activity_selection(callback: CallbackQuery):
         return
 
     is_subscribed = await db.is_user_subscribed(user_id, activity_id)
-    keyboard = await get_activity_details_keyboard(activity_id, is_subscribed)
+    keyboard = get_activity_details_keyboard(activity_id, is_subscribed)
     
     text = f"<b>{activity['name']}</b>\n\n{activity['description']}"
     
@@ -94,7 +94,7 @@ async def process_subscribe(callback: CallbackQuery):
     
     activity = await db.get_activity(activity_id)
     is_subscribed = await db.is_user_subscribed(user_id, activity_id)
-    keyboard = await get_activity_details_keyboard(activity_id, is_subscribed)
+    keyboard = get_activity_details_keyboard(activity_id, is_subscribed)
     
     text = f"<b>{activity['name']}</b>\n\n{activity['description']}"
     events = await db.get_events_for_activity(activity_id)
@@ -131,7 +131,7 @@ async def process_unsubscribe(callback: CallbackQuery):
 
     activity = await db.get_activity(activity_id)
     is_subscribed = await db.is_user_subscribed(user_id, activity_id)
-    keyboard = await get_activity_details_keyboard(activity_id, is_subscribed)
+    keyboard = get_activity_details_keyboard(activity_id, is_subscribed)
 
     text = f"<b>{activity['name']}</b>\n\n{activity['description']}"
     events = await db.get_events_for_activity(activity_id)
@@ -168,9 +168,9 @@ async def back_to_activities_list(callback: CallbackQuery):
         await callback.answer()
         return
 
-    user_subscriptions = await db.get_user_subscriptions(user_id)
+    user_sub_ids = frozenset(sub['activity_id'] for sub in await db.get_user_subscriptions(user_id))
     
-    keyboard = await get_activities_keyboard(activities_to_show, user_subscriptions)
+    keyboard = get_activities_keyboard(activities_to_show, user_sub_ids)
     explanation_text = (
         "«Активность» — это направление деятельности или «кружок по интересам», "
         "который является контейнером для событий. Подпишитесь, чтобы участвовать.\n\n"
@@ -244,7 +244,7 @@ async def cmd_edit_activity(message: Message):
         await message.answer("Нет активностей для редактирования.")
         return
     
-    keyboard = await get_activities_keyboard(activities, action="edit")
+    keyboard = get_activities_keyboard(activities, action="edit")
     await message.answer("Выберите активность для редактирования:", reply_markup=keyboard)
 
 @router.callback_query(F.data.startswith("edit_activity_"))
@@ -280,7 +280,7 @@ async def back_to_edit_list(callback: CallbackQuery, state: FSMContext):
     """Возвращает к списку активностей для редактирования."""
     await state.clear()
     activities = await db.get_all_activities()
-    keyboard = await get_activities_keyboard(activities, action="edit")
+    keyboard = get_activities_keyboard(activities, action="edit")
     await callback.message.edit_text("Выберите активность для редактирования:", reply_markup=keyboard)
     await callback.answer()
 
@@ -359,7 +359,7 @@ async def cmd_delete_activity(message: Message):
         await message.answer("Нет активностей для удаления.")
         return
     
-    keyboard = await get_activities_keyboard(activities, action="delete")
+    keyboard = get_activities_keyboard(activities, action="delete")
     await message.answer("Выберите активность для удаления:", reply_markup=keyboard)
 
 @router.callback_query(F.data.startswith("delete_activity_"))
@@ -11,7 +11,7 @@ from psycopg.rows import dict_row
 
 from app.database import db
 from app.states import AdminEditStates
-from app.utils import is_admin, format_amount, get_user_balance, format_transactions_history
+from app.utils import is_admin, format_amount, get_user_balance, format_transactions_history_async, invalidate_user
 from config import CURRENCY_SYMBOL, DEFAULT_GIDE_TEXT, DEFAULT_TEST_COMMANDS_TEXT, DEFAULT_REMINDER_TEXT, DEFAULT_WELCOME_MESSAGE_GROUP, DEFAULT_WELCOME_MESSAGE_BOT
 
 router = Router()
@@ -99,6 +99,7 @@ async def cmd_add(message: Message, bot: Bot):
             await conn.execute("UPDATE users SET transaction_count = transaction_count + 1 WHERE id = %s", (user['id'],))
             
     await db.handle_debt_repayment(user['id'])
+    invalidate_user(user['telegram_id'])
     
     await message.answer(f"✅ Начислено {format_amount(amount)} {CURRENCY_SYMBOL} пользователю @{username}.")
     if username != 'fund':
@@ -134,6 +135,7 @@ async def cmd_rem(message: Message, bot: Bot):
             await conn.execute("UPDATE users SET balance = balance - %s WHERE id = %s", (amount, user['id']))
             await conn.execute("INSERT INTO transactions (from_user_id, to_user_id, amount, type, comment) VALUES (%s, 0, %s, 'manual_rem', %s)", (user['id'], amount, comment))
             await conn.execute("UPDATE users SET transaction_count = transaction_count + 1 WHERE id = %s", (user['id'],))
+    invalidate_user(user['telegram_id'])
             
     await message.answer(f"✅ Списано {format_amount(amount)} {CURRENCY_SYMBOL} с пользователя @{username}.")
     if username != 'fund':
@@ -185,7 +187,7 @@ async def cmd_check(message: Message):
         response_parts.append("\n<i>История транзакций за последний месяц пуста.</i>")
     else:
         response_parts.append("\n<b>📜 История за последние 30 дней:</b>")
-        history_text = format_transactions_history(all_txs, user['id'])
+        history_text = await format_transactions_history_async(all_txs, user['id'])
         response_parts.append(history_text)
 
     await message.answer("".join(response_parts), parse_mode="HTML")
@@ -226,6 +228,8 @@ async def cmd_pay_from_fund(message: Message, bot: Bot):
             await conn.execute("UPDATE users SET transaction_count = transaction_count + 1 WHERE id = %s", (recipient['id'],))
 
     await db.handle_debt_repayment(recipient['id'])
+    invalidate_user(fund['telegram_id'])
+    invalidate_user(recipient['telegram_id'])
     
     logger.info(f"Admin {message.from_user.id} paid {amount} from fund to user {recipient['telegram_id']}")
     await message.answer(f"✅ Выплачено {format_amount(amount)} {CURRENCY_SYMBOL} из фонда пользователю @{username}.")
@@ -254,6 +258,7 @@ async def cmd_make_admin(message: Message):
         await message.reply(f"✅ Пользователь @{username} уже является администратором.")
         return
     await db.set_admin_status(user['telegram_id'], is_admin=True)
+    invalidate_user(user['telegram_id'])
     await message.answer(f"✅ Пользователь @{username} назначен администратором.")
 
 @router.message(Command("remove_admin", ignore_case=True))
@@ -272,6 +277,7 @@ async def cmd_remove_admin(message: Message):
         await message.reply(f"✅ Пользователь @{username} не является администратором.")
         return
     await db.set_admin_status(user['telegram_id'], is_admin=False)
+    invalidate_user(user['telegram_id'])
     await message.answer(f"✅ С пользователя @{username} сняты права администратора.")
 
 @router.message(Command("edit_welcome_bot", ignore_case=True))
@@ -11,7 +11,7 @@ from config import (
     DEFAULT_WELCOME_MESSAGE_GROUP, DEFAULT_HELP_TEXT_USER, DEFAULT_HELP_TEXT_ADMIN_ADDON,
     DEFAULT_HELP_TEXT_GROUP
 )
-from app.utils import ensure_user_exists, is_admin, is_user_in_group, format_amount
+from app.utils import ensure_user_exists, invalidate_group_membership, invalidate_user, is_admin, is_user_in_group, format_amount
 from app.database import db
 from app.keyboards import get_activities_keyboard
 from decimal import Decimal, InvalidOperation
@@ -88,6 +88,8 @@ async def cmd_start(message: Message, state: FSMContext):
                             (user_id, welcome_bonus, "Welcome-бонус для нового участника")
                         )
                         logger.info(f"Welcome bonus {welcome_bonus} credited to user {message.from_user.id}")
+                # Сбрасываем кэш после выхода из блока, когда бонус уже зафиксирован в БД
+                invalidate_user(message.from_user.id)
         except (ValueError, TypeError, InvalidOperation) as e:
             logger.error(f"Could not parse welcome_bonus_amount '{bonus_amount_str}': {e}")
             welcome_bonus = Decimal('0')
@@ -115,8 +117,8 @@ async def cmd_start(message: Message, state: FSMContext):
             activities_to_show.append(act)
     
     if activities_to_show:
-        user_subscriptions = await db.get_user_subscriptions(message.from_user.id)
-        keyboard = await get_activities_keyboard(activities_to_show, user_subscriptions)
+        user_sub_ids = frozenset(sub['activity_id'] for sub in await db.get_user_subscriptions(message.from_user.id))
+        keyboard = get_activities_keyboard(activities_to_show, user_sub_ids)
         await message.answer(
             "👇 Вы можете выбрать интересующие вас активности для подписки:",
             reply_markup=keyboard
@@ -154,6 +156,7 @@ async def on_user_join(event: ChatMemberUpdated, bot: Bot):
         return
 
     logger.info(f"User {new_member.full_name} ({new_member.id}) joined the main group")
+    invalidate_group_membership(new_member.id)
     
     is_new_user = await ensure_user_exists(new_member.id, new_member.username, new_member.is_bot)
     
@@ -176,6 +179,8 @@ async def on_user_join(event: ChatMemberUpdated, bot: Bot):
                             (user_id, welcome_bonus, "Welcome-бонус за вступление в группу")
                         )
                         logger.info(f"Welcome bonus {welcome_bonus} credited to new member {new_member.id}")
+                # Сбрасываем кэш после выхода из блока, когда бонус уже зафиксирован в БД
+                invalidate_user(new_member.id)
         except (ValueError, TypeError, InvalidOperation) as e:
             logger.error(f"Could not parse welcome_bonus_amount for new member '{bonus_amount_str}': {e}")
             welcome_bonus = Decimal('0')
@@ -68,7 +68,11 @@ async def cmd_event(message: Message):
         await message.answer("На ближайшую неделю событий не запланировано.")
         return
 
-    keyboard = await get_events_keyboard([event for _, event in this_week])
+    # Даты уже посчитаны выше — передаем их, чтобы клавиатура не вычисляла их повторно
+    keyboard = get_events_keyboard(
+        [event for _, event in this_week],
+        next_runs=[next_run for next_run, _ in this_week]
+    )
     await message.answer(
         "📅 События на ближайшие 7 дней (время указывается в MSK):",
         reply_markup=keyboard
@@ -112,7 +116,7 @@ async def process_event_selection(callback: CallbackQuery):
         f"💰 Стоимость: {format_amount(event['cost'])} {CURRENCY_SYMBOL}\n"
         f"🔗 Ссылка будет отправлена подписчикам в личные сообщения."
     )
-    keyboard = await get_event_details_keyboard(event_id)
+    keyboard = get_event_details_keyboard(event_id)
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
@@ -350,7 +354,7 @@ async def cmd_edit_event(message: Message):
         await message.answer("Нет событий для редактирования.")
         return
 
-    keyboard = await get_events_keyboard(events, action="edit")
+    keyboard = get_events_keyboard(events, action="edit")
     await message.answer("Выберите событие для редактирования (время отображается в MSK):", reply_markup=keyboard)
 
 @router.callback_query(F.data.startswith("edit_event_"))
@@ -389,7 +393,7 @@ async def process_edit_event_selection(callback: CallbackQuery, state: FSMContex
 
     info_text = "\n".join(info_parts)
 
-    keyboard = await get_event_edit_keyboard(event_id)
+    keyboard = get_event_edit_keyboard(event_id)
     await callback.message.edit_text(info_text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
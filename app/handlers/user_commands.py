@@ -8,16 +8,19 @@ from aiogram import Router, F, Bot
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
+from psycopg import Rollback
 from psycopg.rows import dict_row
 
 from app.database import db
 from app.states import TransferStates
-from app.utils import format_amount, get_user_balance, get_transaction_count, is_user_in_group, ensure_user_exists, format_transactions_history
+from app.utils import format_amount, get_user_balance, get_transaction_count, is_user_in_group, ensure_user_exists, format_transactions_history, invalidate_user, quantize_amount, run_in_background
 from config import CURRENCY_SYMBOL
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+HISTORY_PAGE_SIZE = 50
+
 @router.message(Command("balance", "баланс", ignore_case=True))
 async def cmd_balance(message: Message):
     """Обработчик команды /balance."""
@@ -34,7 +37,6 @@ async def cmd_balance(message: Message):
 async def cmd_send(message: Message, state: FSMContext, bot: Bot):
     """Обработчик команды /send с диалогом для комментария."""
     logger.info(f"User {message.from_user.id} initiated /send command: {message.text}")
-    await ensure_user_exists(message.from_user.id, message.from_user.username, message.from_user.is_bot)
     args = message.text.split()
     
     if len(args) < 3:
@@ -49,7 +51,7 @@ async def cmd_send(message: Message, state: FSMContext, bot: Bot):
         return
 
     try:
-        amount = Decimal(args[2])
+        amount = quantize_amount(Decimal(args[2]))
         if amount <= 0:
             raise ValueError("Сумма должна быть положительной.")
     except (InvalidOperation, ValueError):
@@ -57,6 +59,9 @@ async def cmd_send(message: Message, state: FSMContext, bot: Bot):
         await message.reply(f"❌ Неверная сумма. Пожалуйста, укажите положительное число.")
         return
 
+    # Регистрируем отправителя только после синтаксической проверки команды
+    await ensure_user_exists(message.from_user.id, message.from_user.username, message.from_user.is_bot)
+
     if recipient_username == 'fund':
         recipient = await db.get_user(telegram_id=0)
     else:
@@ -107,17 +112,24 @@ async def process_transfer_comment(message: Message, state: FSMContext, bot: Bot
 
     await process_transfer(message, recipient_id, recipient_telegram_id, recipient_username, amount, comment, bot)
 
+async def _answer_insufficient_funds(message: Message, sender_id: int, balance: Decimal, amount: Decimal):
+    """Сообщает отправителю, что средств на перевод не хватает."""
+    logger.warning(f"Insufficient balance for user {sender_id}: {balance} < {amount}")
+    await message.answer(f"❌ Недостаточно средств. Ваш баланс: <b>{format_amount(balance)} {CURRENCY_SYMBOL}</b>", parse_mode="HTML")
+
 async def process_transfer(message: Message, recipient_id: int, recipient_telegram_id: int, recipient_username: str, amount: Decimal, comment: str, bot: Bot):
     """Выполняет атомарную транзакцию перевода средств."""
     sender_id = message.from_user.id
     sender_username = message.from_user.username or f"user{sender_id}"
 
-    sender_balance = await get_user_balance(sender_id)
+    # Баланс для проверки читаем из БД, а не из кэша: от него зависит списание
+    sender = await db.get_user(telegram_id=sender_id)
+    sender_balance = sender['balance'] if sender else Decimal('0')
     if sender_balance < amount:
-        logger.warning(f"Insufficient balance for user {sender_id}: {sender_balance} < {amount}")
-        await message.answer(f"❌ Недостаточно средств. Ваш баланс: <b>{format_amount(sender_balance)} {CURRENCY_SYMBOL}</b>", parse_mode="HTML")
+        await _answer_insufficient_funds(message, sender_id, sender_balance, amount)
         return
 
+    transferred = False
     try:
         async with db.pool.connection() as conn:
             async with conn.transaction():
@@ -126,7 +138,13 @@ async def process_transfer(message: Message, recipient_id: int, recipient_telegr
                 sender_db_id_row = await result_cursor.fetchone()
                 sender_db_id = sender_db_id_row[0]
                 
-                await conn.execute("UPDATE users SET balance = balance - %s WHERE id = %s", (amount, sender_db_id))
+                # Условное списание — окончательная защита от ухода в минус при параллельных операциях
+                result_cursor = await conn.execute(
+                    "UPDATE users SET balance = balance - %s WHERE id = %s AND balance >= %s RETURNING balance",
+                    (amount, sender_db_id, amount)
+                )
+                if await result_cursor.fetchone() is None:
+                    raise Rollback()
                 await conn.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (amount, recipient_id))
                 
                 await conn.execute(
@@ -135,39 +153,55 @@ async def process_transfer(message: Message, recipient_id: int, recipient_telegr
                 )
                 
                 await conn.execute("UPDATE users SET transaction_count = transaction_count + 1 WHERE id IN (%s, %s)", (sender_db_id, recipient_id))
+                transferred = True
         
-        logger.info(f"Transfer successful: {sender_id} -> {recipient_telegram_id}, amount: {amount}")
-        await db.handle_debt_repayment(recipient_id)
+        if transferred:
+            logger.info(f"Transfer successful: {sender_id} -> {recipient_telegram_id}, amount: {amount}")
+            await db.handle_debt_repayment(recipient_id)
+            invalidate_user(sender_id)
+            invalidate_user(recipient_telegram_id)
 
     except Exception as e:
         logger.error(f"Transaction failed between users {sender_id} -> {recipient_telegram_id}: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при выполнении перевода. Попробуйте позже.")
         return
 
+    if not transferred:
+        # Баланс успел уменьшиться между проверкой и списанием — транзакция откатилась
+        sender = await db.get_user(telegram_id=sender_id)
+        await _answer_insufficient_funds(message, sender_id, sender['balance'] if sender else Decimal('0'), amount)
+        return
+
+    amount_text = f"{format_amount(amount)} {CURRENCY_SYMBOL}"
     await message.answer(
         f"✅ Перевод выполнен!\n\n"
         f"<b>Получатель:</b> @{recipient_username}\n"
-        f"<b>Сумма:</b> {format_amount(amount)} {CURRENCY_SYMBOL}\n"
+        f"<b>Сумма:</b> {amount_text}\n"
         f"<b>Комментарий:</b> {comment}",
         parse_mode="HTML"
     )
     
     if recipient_telegram_id != 0:
-        try:
-            await bot.send_message(
-                recipient_telegram_id,
-                f"💸 Вам поступил перевод!\n\n"
-                f"<b>Отправитель:</b> @{sender_username}\n"
-                f"<b>Сумма:</b> {format_amount(amount)} {CURRENCY_SYMBOL}\n"
-                f"<b>Комментарий:</b> {comment}",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.warning(f"Could not send notification to recipient {recipient_telegram_id}: {e}")
+        # Уведомление получателю не должно задерживать ответ отправителю
+        run_in_background(_notify_recipient(bot, recipient_telegram_id, sender_username, amount_text, comment))
+
+async def _notify_recipient(bot: Bot, recipient_telegram_id: int, sender_username: str, amount_text: str, comment: str):
+    """Уведомляет получателя о поступившем переводе."""
+    try:
+        await bot.send_message(
+            recipient_telegram_id,
+            f"💸 Вам поступил перевод!\n\n"
+            f"<b>Отправитель:</b> @{sender_username}\n"
+            f"<b>Сумма:</b> {amount_text}\n"
+            f"<b>Комментарий:</b> {comment}",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.warning(f"Could not send notification to recipient {recipient_telegram_id}: {e}")
 
 @router.message(Command("history", ignore_case=True))
 async def cmd_history(message: Message):
-    """Обработчик команды /history."""
+    """Обработчик команды /history [дней] [страница]."""
     await ensure_user_exists(message.from_user.id, message.from_user.username, message.from_user.is_bot)
     
     args = message.text.split()
@@ -175,6 +209,10 @@ async def cmd_history(message: Message):
         days = int(args[1]) if len(args) > 1 else 30
     except (ValueError, IndexError):
         days = 30
+    try:
+        page = max(int(args[2]), 1) if len(args) > 2 else 1
+    except (ValueError, IndexError):
+        page = 1
 
     user_id = message.from_user.id
     current_balance = await get_user_balance(user_id)
@@ -200,59 +238,74 @@ async def cmd_history(message: Message):
                 LEFT JOIN users recipient ON t.to_user_id = recipient.id
                 WHERE (t.to_user_id = %s OR t.from_user_id = %s) AND t.created_at > %s
                 ORDER BY t.created_at DESC
-            """, (user_db_id, user_db_id, date_limit))
+                LIMIT %s OFFSET %s
+            """, (user_db_id, user_db_id, date_limit, HISTORY_PAGE_SIZE + 1, (page - 1) * HISTORY_PAGE_SIZE))
             all_txs = await cur.fetchall()
 
     if not all_txs:
-        await message.answer(f"За последние {days} дней транзакций не найдено.")
+        if page > 1:
+            await message.answer(f"На странице {page} транзакций за последние {days} дней нет.")
+        else:
+            await message.answer(f"За последние {days} дней транзакций не найдено.")
         return
 
-    response_parts = [f"📊 <b>История транзакций за последние {days} дней:</b>"]
+    # Запрашиваем на одну запись больше, чтобы узнать, есть ли следующая страница
+    has_next_page = len(all_txs) > HISTORY_PAGE_SIZE
+    all_txs = all_txs[:HISTORY_PAGE_SIZE]
+
     history_text = format_transactions_history(all_txs, user_db_id)
-    response_parts.append(history_text)
-    response_parts.append(f"\n💰 <b>Текущий баланс:</b> {format_amount(current_balance)} {CURRENCY_SYMBOL}")
-    
-    await message.answer("".join(response_parts), parse_mode="HTML")
+    pagination_hint = (
+        f"\n<i>Показаны {HISTORY_PAGE_SIZE} транзакций (страница {page}). "
+        f"Следующая страница: /history {days} {page + 1}</i>\n"
+        if has_next_page else ""
+    )
+    response = (
+        f"📊 <b>История транзакций за последние {days} дней:</b>"
+        f"{history_text}"
+        f"{pagination_hint}"
+        f"\n💰 <b>Текущий баланс:</b> {format_amount(current_balance)} {CURRENCY_SYMBOL}"
+    )
+
+    await message.answer(response, parse_mode="HTML")
 
 
 @router.message(Command("gdp", "ввп", ignore_case=True))
 async def cmd_gdp(message: Message):
     """Обработчик команды /gdp."""
+    now = datetime.now()
     async with db.pool.connection() as conn:
         async with conn.cursor(row_factory=dict_row) as cur:
-            now = datetime.now()
-            
-            async def get_turnover_and_count(days=None):
-                query = "SELECT COALESCE(SUM(amount), 0) as turnover, COUNT(id) as tx_count FROM transactions WHERE type = 'transfer'"
-                params = []
-                if days:
-                    query += " AND created_at > %s"
-                    params.append(now - timedelta(days=days))
-                await cur.execute(query, params)
-                return await cur.fetchone()
-            
-            turnover_7d_data = await get_turnover_and_count(7)
-            turnover_30d_data = await get_turnover_and_count(30)
-            turnover_all_data = await get_turnover_and_count()
-            
-            await cur.execute("SELECT COALESCE(SUM(balance), 0) as total FROM users")
-            total_supply_data = await cur.fetchone()
-            total_supply = total_supply_data['total']
-            
-            await cur.execute("SELECT balance FROM users WHERE id = 0")
-            fund_balance_data = await cur.fetchone()
-            fund_balance = fund_balance_data['balance']
-            
-            response = f"""
+            # Все показатели считаются одним запросом, чтобы не платить за несколько обращений к БД
+            await cur.execute("""
+                SELECT t.*, u.*
+                FROM (
+                    SELECT COALESCE(SUM(amount) FILTER (WHERE created_at > %(since_7d)s), 0) AS turnover_7d,
+                           COUNT(id) FILTER (WHERE created_at > %(since_7d)s) AS tx_count_7d,
+                           COALESCE(SUM(amount) FILTER (WHERE created_at > %(since_30d)s), 0) AS turnover_30d,
+                           COUNT(id) FILTER (WHERE created_at > %(since_30d)s) AS tx_count_30d,
+                           COALESCE(SUM(amount), 0) AS turnover_all,
+                           COUNT(id) AS tx_count_all
+                    FROM transactions
+                    WHERE type = 'transfer'
+                ) t
+                CROSS JOIN (
+                    SELECT COALESCE(SUM(balance), 0) AS total_supply,
+                           COALESCE(SUM(balance) FILTER (WHERE id = 0), 0) AS fund_balance
+                    FROM users
+                ) u
+            """, {'since_7d': now - timedelta(days=7), 'since_30d': now - timedelta(days=30)})
+            stats = await cur.fetchone()
+
+    response = f"""
 📊 <b>Экономика сообщества:</b>
 
 💱 <b>Оборот (переводы между пользователями):</b>
-• За 7 дней: {format_amount(turnover_7d_data['turnover'])} {CURRENCY_SYMBOL} ({turnover_7d_data['tx_count']} транзакций)
-• За 30 дней: {format_amount(turnover_30d_data['turnover'])} {CURRENCY_SYMBOL} ({turnover_30d_data['tx_count']} транзакций)
-• За все время: {format_amount(turnover_all_data['turnover'])} {CURRENCY_SYMBOL} ({turnover_all_data['tx_count']} транзакций)
+• За 7 дней: {format_amount(stats['turnover_7d'])} {CURRENCY_SYMBOL} ({stats['tx_count_7d']} транзакций)
+• За 30 дней: {format_amount(stats['turnover_30d'])} {CURRENCY_SYMBOL} ({stats['tx_count_30d']} транзакций)
+• За все время: {format_amount(stats['turnover_all'])} {CURRENCY_SYMBOL} ({stats['tx_count_all']} транзакций)
 
 💰 <b>Денежная масса:</b>
-• Всего в системе: {format_amount(total_supply)} {CURRENCY_SYMBOL}
-• В фонде сообщества: {format_amount(fund_balance)} {CURRENCY_SYMBOL}
+• Всего в системе: {format_amount(stats['total_supply'])} {CURRENCY_SYMBOL}
+• В фонде сообщества: {format_amount(stats['fund_balance'])} {CURRENCY_SYMBOL}
 """
-            await message.answer(response, parse_mode="HTML")
+    await message.answer(response, parse_mode="HTML")
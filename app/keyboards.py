@@ -1,125 +1,139 @@
 # XBalanseBot/app/keyboards.py
+from functools import lru_cache
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 from app.utils import get_next_run_time
 
 MSK_LABEL = "MSK"
+_WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
 
+# Префиксы callback_data для списков активностей и событий по действию
+_ACTIVITY_CB = {"view": "activity_", "edit": "edit_activity_", "delete": "delete_activity_"}
+_EVENT_CB = {"view": "event_", "edit": "edit_event_", "delete": "delete_event_"}
+
+# Неизменяемые клавиатуры кэшируются: aiogram только сериализует разметку при отправке и не изменяет её
+@lru_cache(maxsize=512)
 def confirm_delete_keyboard(callback_data: str) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.row(
+    return InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="✅ Да, удалить", callback_data=callback_data),
         InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")
-    )
-    return builder.as_markup()
+    ]])
+
+def get_activities_keyboard(activities: list, user_sub_ids: frozenset = frozenset(), action: str = "view") -> InlineKeyboardMarkup:
+    """
+    Строит клавиатуру со списком активностей.
 
-async def get_activities_keyboard(activities: list, user_subscriptions: list = None, action: str = "view") -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    user_sub_ids = {sub['activity_id'] for sub in user_subscriptions} if user_subscriptions else set()
+    Args:
+        user_sub_ids: ID активностей, на которые подписан пользователь (для отметки ✅).
+    """
+    rows = []
+    action_prefix = _ACTIVITY_CB.get(action, "activity_")
+    mark_subscribed = action == "view"
 
     for activity in activities:
-        if action == "delete" and activity['id'] == 1:
+        activity_id = activity['id']
+        if action == "delete" and activity_id == 1:
             continue
 
-        is_subscribed = activity['id'] in user_sub_ids
-        text = f"✅ {activity['name']}" if is_subscribed and action == "view" else activity['name']
-
-        if action == "view":
-            cb = f"activity_{activity['id']}"
-        elif action == "edit":
-            cb = f"edit_activity_{activity['id']}"
-        elif action == "delete":
-            cb = f"delete_activity_{activity['id']}"
-        else:
-            cb = f"activity_{activity['id']}"
+        name = activity['name']
+        text = f"✅ {name}" if mark_subscribed and activity_id in user_sub_ids else name
 
-        builder.row(InlineKeyboardButton(text=text, callback_data=cb))
+        rows.append([InlineKeyboardButton(text=text, callback_data=f"{action_prefix}{activity_id}")])
 
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
-async def get_activity_details_keyboard(activity_id: int, is_subscribed: bool) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
+@lru_cache(maxsize=512)
+def get_activity_details_keyboard(activity_id: int, is_subscribed: bool) -> InlineKeyboardMarkup:
+    rows = []
     if activity_id != 1:
         if is_subscribed:
-            builder.row(InlineKeyboardButton(text="❌ Отписаться", callback_data=f"unsubscribe_{activity_id}"))
+            rows.append([InlineKeyboardButton(text="❌ Отписаться", callback_data=f"unsubscribe_{activity_id}")])
         else:
-            builder.row(InlineKeyboardButton(text="✅ Подписаться", callback_data=f"subscribe_{activity_id}"))
-    builder.row(InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="back_to_activities"))
-    return builder.as_markup()
+            rows.append([InlineKeyboardButton(text="✅ Подписаться", callback_data=f"subscribe_{activity_id}")])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="back_to_activities")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 async def get_activities_keyboard_for_event(activities: list) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
+    rows = []
     for activity in activities:
         if activity['id'] == 1:
-            builder.row(InlineKeyboardButton(text=f"{activity['name']} (для всех)", callback_data=f"select_activity_1"))
+            rows.append([InlineKeyboardButton(text=f"{activity['name']} (для всех)", callback_data=f"select_activity_1")])
         else:
-            builder.row(InlineKeyboardButton(text=activity['name'], callback_data=f"select_activity_{activity['id']}"))
-    return builder.as_markup()
-
-async def get_events_keyboard(events: list, action: str = "view") -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    weekdays_map = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-
-    for event_row in events:
-        event = dict(event_row)
-        next_run = get_next_run_time(
-            event['event_type'],
-            event.get('event_date'),
-            event.get('weekday'),
-            event.get('event_time'),
-            event.get('last_run')
-        )
-
+            rows.append([InlineKeyboardButton(text=activity['name'], callback_data=f"select_activity_{activity['id']}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def get_events_keyboard(events: list, action: str = "view", next_runs: list | None = None) -> InlineKeyboardMarkup:
+    """
+    Строит клавиатуру со списком событий.
+
+    Args:
+        next_runs: Уже вычисленные даты следующего запуска в том же порядке, что и events.
+            Если не переданы, вычисляются здесь.
+    """
+    rows = []
+    if next_runs is None:
+        next_runs = [
+            get_next_run_time(
+                event['event_type'],
+                event.get('event_date'),
+                event.get('weekday'),
+                event.get('event_time'),
+                event.get('last_run')
+            )
+            for event in events
+        ]
+
+    # Строки из dict_row уже являются словарями — копировать их не нужно
+    action_prefix = _EVENT_CB.get(action, "event_")
+
+    for event, next_run in zip(events, next_runs):
         if next_run:
-            date_str = next_run.strftime('%d.%m')
-            weekday_str = weekdays_map[next_run.weekday()]
-            time_str = next_run.strftime('%H:%M')
-            schedule_str = f"{date_str} ({weekday_str}) {time_str} ({MSK_LABEL})"
+            # Форматируем числами напрямую, без strftime
+            schedule_str = (
+                f"{next_run.day:02d}.{next_run.month:02d} ({_WEEKDAYS[next_run.weekday()]}) "
+                f"{next_run.hour:02d}:{next_run.minute:02d} ({MSK_LABEL})"
+            )
         else:
             schedule_str = f"Дата не определена ({MSK_LABEL})"
 
-        display_name = event.get('name') or event.get('activity_name')
+        display_name = event['name'] or event['activity_name']
         text = f"{schedule_str} - {display_name}"
 
-        event_id = event['id']
-        if action == "view":
-            cb = f"event_{event_id}"
-        elif action == "edit":
-            cb = f"edit_event_{event_id}"
-        elif action == "delete":
-            cb = f"delete_event_{event_id}"
-        else:
-            cb = f"event_{event_id}"
-
-        builder.row(InlineKeyboardButton(text=text, callback_data=cb))
-    return builder.as_markup()
-
-async def get_event_details_keyboard(event_id: int) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="back_to_events"))
-    return builder.as_markup()
-
-async def get_event_edit_keyboard(event_id: int) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="Название", callback_data=f"edit_evt_name_{event_id}"),
-        InlineKeyboardButton(text="Описание", callback_data=f"edit_evt_description_{event_id}")
-    )
-    builder.row(
-        InlineKeyboardButton(text="Расписание", callback_data=f"edit_evt_schedule_{event_id}"),
-        InlineKeyboardButton(text="Стоимость", callback_data=f"edit_evt_cost_{event_id}")
-    )
-    builder.row(
-        InlineKeyboardButton(text="Ссылку", callback_data=f"edit_evt_link_{event_id}"),
-        InlineKeyboardButton(text="Напоминание", callback_data=f"edit_evt_reminder_{event_id}")
-    )
-    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_events"))
-    return builder.as_markup()
-
-def get_weekday_keyboard() -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
+        rows.append([InlineKeyboardButton(text=text, callback_data=f"{action_prefix}{event['id']}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@lru_cache(maxsize=512)
+def get_event_details_keyboard(event_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="back_to_events")]
+    ])
+
+@lru_cache(maxsize=512)
+def get_event_edit_keyboard(event_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Название", callback_data=f"edit_evt_name_{event_id}"),
+            InlineKeyboardButton(text="Описание", callback_data=f"edit_evt_description_{event_id}")
+        ],
+        [
+            InlineKeyboardButton(text="Расписание", callback_data=f"edit_evt_schedule_{event_id}"),
+            InlineKeyboardButton(text="Стоимость", callback_data=f"edit_evt_cost_{event_id}")
+        ],
+        [
+            InlineKeyboardButton(text="Ссылку", callback_data=f"edit_evt_link_{event_id}"),
+            InlineKeyboardButton(text="Напоминание", callback_data=f"edit_evt_reminder_{event_id}")
+        ],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_events")]
+    ])
+
+def _build_weekday_keyboard() -> InlineKeyboardMarkup:
     weekdays = {"Пн": 0, "Вт": 1, "Ср": 2, "Чт": 3, "Пт": 4, "Сб": 5, "Вс": 6}
     buttons = [InlineKeyboardButton(text=day, callback_data=f"select_weekday_{idx}") for day, idx in weekdays.items()]
-    builder.row(*buttons)
-    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete"))
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[
+        buttons,
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")]
+    ])
+
+_WEEKDAY_KEYBOARD = _build_weekday_keyboard()
+
+def get_weekday_keyboard() -> InlineKeyboardMarkup:
+    return _WEEKDAY_KEYBOARD
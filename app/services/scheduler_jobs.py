@@ -1,28 +1,48 @@
 # XBalanseBot/app/services/scheduler_jobs.py
 # v1.5.5 - 2025-08-17 (restore process_demurrage; explicit MSK in user messages)
+import asyncio
 import logging
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from decimal import Decimal
 from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.base import JobLookupError
-from psycopg.rows import dict_row
+from psycopg import AsyncConnection
+from psycopg.pq import TransactionStatus
 from zoneinfo import ZoneInfo
 
 from app.database import db
-from app.utils import format_amount, get_next_run_time
+from app.utils import format_amount, get_next_run_time, invalidate_user, run_in_background
 from config import CURRENCY_SYMBOL, DEFAULT_REMINDER_TEXT
 
 logger = logging.getLogger(__name__)
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 MSK_LABEL = "MSK"
+# Ключ pg_advisory_lock, исключающий параллельный запуск демерреджа
+DEMURRAGE_LOCK_KEY = 918273
+# Сколько пользователей облагается демерреджем в одной транзакции
+DEMURRAGE_BATCH_SIZE = 500
+
+# ID задач событий, поставленных в планировщик этим процессом
+_scheduled_ids: set[str] = set()
+# Ограничение числа одновременных запросов к Telegram API при рассылке
+SEND_SEM = asyncio.Semaphore(25)
+# Темп рассылки: не чаще SEND_RATE_PER_SECOND сообщений в секунду, чуть ниже лимита Telegram в 30 сообщений/с
+SEND_RATE_PER_SECOND = 25
+SEND_INTERVAL = 1 / SEND_RATE_PER_SECOND
+# Сколько раз повторять отправку после ответа 429 (TelegramRetryAfter)
+SEND_MAX_RETRIES = 3
+# Время (loop.time()), раньше которого нельзя начинать следующую отправку
+_next_send_at = 0.0
+_send_slot_lock = asyncio.Lock()
 
 async def schedule_event_jobs(event: dict, bot: Bot, scheduler: AsyncIOScheduler):
     """
     Планирует или перепланирует задачи для одного события (оплата и напоминание).
     """
     event_id = event['id']
-    remove_event_jobs(event_id, scheduler)
+    now = datetime.now(MOSCOW_TZ)
 
     next_run = get_next_run_time(
         event_type=event['event_type'],
@@ -32,40 +52,117 @@ async def schedule_event_jobs(event: dict, bot: Bot, scheduler: AsyncIOScheduler
         last_run=event.get('last_run')
     )
 
-    if not next_run or next_run < datetime.now(next_run.tzinfo):
+    if not next_run or next_run < now:
         logger.info(f"Event {event_id} has no valid next run time in the future. Not scheduling.")
+        remove_event_jobs(event_id, scheduler)
         return
 
+    # replace_existing=True заменяет прежнюю задачу атомарно, без отдельного remove_job
     scheduler.add_job(
         run_event_payment,
         'date',
         run_date=next_run,
         args=[event_id, bot, scheduler],
-        id=f"event_payment_{event_id}"
+        id=f"event_payment_{event_id}",
+        replace_existing=True,
+        misfire_grace_time=300
     )
+    _scheduled_ids.add(f"event_payment_{event_id}")
     logger.info(f"Scheduled payment for event {event_id} at {next_run}")
 
+    reminder_datetime = None
     if event['reminder_time'] and event['reminder_time'] > 0:
-        from datetime import timedelta
         reminder_datetime = next_run - timedelta(minutes=event['reminder_time'])
-        if reminder_datetime > datetime.now(reminder_datetime.tzinfo):
-            scheduler.add_job(
-                run_event_reminder,
-                'date',
-                run_date=reminder_datetime,
-                args=[event_id, bot],
-                id=f"event_reminder_{event_id}"
-            )
-            logger.info(f"Scheduled reminder for event {event_id} at {reminder_datetime}")
+
+    if reminder_datetime and reminder_datetime > now:
+        scheduler.add_job(
+            run_event_reminder,
+            'date',
+            run_date=reminder_datetime,
+            args=[event_id, bot],
+            id=f"event_reminder_{event_id}",
+            replace_existing=True,
+            misfire_grace_time=300
+        )
+        _scheduled_ids.add(f"event_reminder_{event_id}")
+        logger.info(f"Scheduled reminder for event {event_id} at {reminder_datetime}")
+    else:
+        # Напоминание отключено или уже в прошлом — снимаем старую задачу, если она была
+        _remove_job(scheduler, f"event_reminder_{event_id}")
+
+async def _wait_send_slot():
+    """Выдает слоты отправки с интервалом SEND_INTERVAL — так рассылка не превышает лимит Telegram."""
+    global _next_send_at
+    async with _send_slot_lock:
+        now = asyncio.get_running_loop().time()
+        delay = _next_send_at - now
+        _next_send_at = max(now, _next_send_at) + SEND_INTERVAL
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+def _postpone_sends(seconds: float):
+    """После 429 сдвигает все последующие отправки: ограничение Telegram действует на бота целиком."""
+    global _next_send_at
+    _next_send_at = max(_next_send_at, asyncio.get_running_loop().time() + seconds)
+
+async def _send(bot: Bot, telegram_id: int, text: str, failure_log: str):
+    """
+    Отправляет одно уведомление с учетом темпа рассылки.
+    При TelegramRetryAfter ждет указанное Telegram время и повторяет отправку; прочие ошибки только логируются.
+    """
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        await _wait_send_slot()
+        async with SEND_SEM:
+            try:
+                # parse_mode берется из DefaultBotProperties бота (HTML)
+                await bot.send_message(telegram_id, text)
+                return
+            except TelegramRetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    logger.warning(f"{failure_log} {telegram_id}: flood control, giving up after {attempt + 1} attempts: {e}")
+                    return
+                logger.info(f"Flood control on send to {telegram_id}, retrying in {e.retry_after}s.")
+                _postpone_sends(e.retry_after)
+            except Exception as e:
+                logger.warning(f"{failure_log} {telegram_id}: {e}")
+                return
+
+async def bulk_reschedule(events: list, bot: Bot, scheduler: AsyncIOScheduler):
+    """
+    Планирует задачи для набора событий разом.
+    Если планировщик уже запущен, он ставится на паузу, чтобы не пересчитывать
+    время пробуждения и не запускать задачи, пока набор задач меняется.
+    """
+    paused = scheduler.running
+    if paused:
+        scheduler.pause()
+    try:
+        for event in events:
+            # Ошибка в одном событии (например, битое расписание) не должна оставить остальные без задач
+            try:
+                await schedule_event_jobs(event, bot, scheduler)
+            except Exception as e:
+                logger.error(f"Failed to schedule jobs for event {event.get('id')}: {e}", exc_info=True)
+    finally:
+        if paused:
+            scheduler.resume()
 
 def remove_event_jobs(event_id: int, scheduler: AsyncIOScheduler):
     """Удаляет задачи для события из планировщика."""
-    for job_id in [f"event_payment_{event_id}", f"event_reminder_{event_id}"]:
-        try:
-            scheduler.remove_job(job_id)
-            logger.info(f"Removed job {job_id} from scheduler.")
-        except JobLookupError:
-            pass
+    for job_id in (f"event_payment_{event_id}", f"event_reminder_{event_id}"):
+        _remove_job(scheduler, job_id)
+
+def _remove_job(scheduler: AsyncIOScheduler, job_id: str):
+    """Удаляет задачу, только если она ставилась этим процессом, — без лишнего обращения к хранилищу задач."""
+    if job_id not in _scheduled_ids:
+        return
+    _scheduled_ids.discard(job_id)
+    try:
+        scheduler.remove_job(job_id)
+        logger.info(f"Removed job {job_id} from scheduler.")
+    except JobLookupError:
+        # Задача типа 'date' уже выполнилась и была удалена планировщиком
+        pass
 
 async def run_event_payment(event_id: int, bot: Bot, scheduler: AsyncIOScheduler):
     """
@@ -80,12 +177,12 @@ async def run_event_payment(event_id: int, bot: Bot, scheduler: AsyncIOScheduler
     
     await handle_payment_for_event(bot, event)
 
-    await db.update_event(event_id, last_run=datetime.now(MOSCOW_TZ))
+    last_run = datetime.now(MOSCOW_TZ)
+    await db.update_event(event_id, last_run=last_run)
 
     if event['event_type'] == 'recurring':
-        updated_event = await db.get_event(event_id)
-        if updated_event:
-            await schedule_event_jobs(updated_event, bot, scheduler)
+        # Изменилось только поле last_run — перечитывать событие из БД не нужно
+        await schedule_event_jobs({**event, 'last_run': last_run}, bot, scheduler)
 
 async def run_event_reminder(event_id: int, bot: Bot):
     """Выполняется по расписанию. Отправляет напоминания."""
@@ -98,6 +195,27 @@ async def run_event_reminder(event_id: int, bot: Bot):
     
     await handle_reminders_for_event(bot, event)
 
+async def _apply_payments(user_ids: list[int], fee: Decimal, event_name: str):
+    """Списывает плату за событие со всех подписчиков в одной транзакции."""
+    fund_user_id = 0
+    comment = f"Оплата за событие: {event_name}"
+
+    async with db.pool.connection() as conn:
+        # Pipeline отправляет оба запроса серверу, не дожидаясь ответа на первый
+        async with conn.transaction(), conn.pipeline():
+            # Списание со всех подписчиков одним UPDATE и одним INSERT ... SELECT вместо 3 запросов на пользователя
+            await conn.execute(
+                "UPDATE users SET balance = balance - %s, transaction_count = transaction_count + 1 WHERE id = ANY(%s)",
+                (fee, user_ids)
+            )
+            await conn.execute(
+                "INSERT INTO transactions (from_user_id, to_user_id, amount, type, comment) "
+                "SELECT id, %s, %s, 'event_fee', %s FROM users WHERE id = ANY(%s)",
+                (fund_user_id, fee, comment, user_ids)
+            )
+    # Балансы изменились у многих пользователей сразу — проще сбросить кэш целиком
+    invalidate_user()
+
 async def handle_payment_for_event(bot: Bot, event: dict):
     """Обрабатывает списания для конкретного наступившего события."""
     event_name = event['name'] or event['activity_name']
@@ -107,81 +225,70 @@ async def handle_payment_for_event(bot: Bot, event: dict):
         return
         
     async with db.pool.connection() as conn:
-        async with conn.cursor(row_factory=dict_row) as cur:
-            if event['activity_id'] == 1:
-                await cur.execute("SELECT * FROM users WHERE telegram_id != 0")
-            else:
-                await cur.execute("""
-                    SELECT u.* FROM users u
-                    JOIN user_subscriptions us ON u.id = us.user_id
-                    WHERE us.activity_id = %s
-                """, (event['activity_id'],))
-            subscribers = await cur.fetchall()
-
-    if not subscribers:
+        async with conn.cursor() as cur:
+            # Нужны только id и telegram_id; запрос одной формы выполняется на каждое событие — готовим его на сервере.
+            # Кортежи вместо dict_row: на «Общих событиях» это все пользователи
+            await cur.execute(
+                "SELECT user_id, telegram_id FROM v_activity_members WHERE activity_id = %s",
+                (event['activity_id'],), prepare=True
+            )
+            rows = await cur.fetchall()
+
+    if not rows:
         logger.info(f"No subscribers found for event {event['id']}, skipping payments.")
         return
 
-    logger.info(f"Processing payments for {len(subscribers)} users for event '{event_name}'.")
-    
-    fund_user_id = 0
-    
-    async with db.pool.connection() as conn:
-        async with conn.transaction():
-            for user in subscribers:
-                user_id = user['id']
-                user_telegram_id = user['telegram_id']
-                
-                await conn.execute("UPDATE users SET balance = balance - %s WHERE id = %s", (fee, user_id))
-                await conn.execute(
-                    "INSERT INTO transactions (from_user_id, to_user_id, amount, type, comment) VALUES (%s, %s, %s, 'event_fee', %s)",
-                    (user_id, fund_user_id, fee, f"Оплата за событие: {event_name}")
-                )
-                await conn.execute("UPDATE users SET transaction_count = transaction_count + 1 WHERE id = %s", (user_id,))
-                
-                # Явно указываем пояс MSK в тексте
-                start_time_str = ""
-                next_run = get_next_run_time(event['event_type'], event.get('event_date'), event.get('weekday'), event.get('event_time'), event.get('last_run'))
-                if next_run:
-                    start_time_str = f"\n🕒 Начало: {next_run.strftime('%d.%m.%Y в %H:%M')} ({MSK_LABEL})"
-
-                notification_text = (
-                    f"▶️ <b>Начинается событие: «{event_name}»</b>\n"
-                    f"🔗 Ссылка для подключения: {event['link']}{start_time_str}\n\n"
-                    f"С вашего счета списано {format_amount(fee)} {CURRENCY_SYMBOL} за участие."
-                )
-                try:
-                    await bot.send_message(
-                        user_telegram_id,
-                        notification_text,
-                        parse_mode="HTML"
-                    )
-                except Exception as e:
-                    logger.warning(f"Failed to send payment notification to user {user_telegram_id}: {e}")
+    user_ids = [row[0] for row in rows]
+    telegram_ids = [row[1] for row in rows]
+    logger.info(f"Processing payments for {len(user_ids)} users for event '{event_name}'.")
     
+    await _apply_payments(user_ids, fee, event_name)
+
+    # Текст одинаков для всех подписчиков — собираем его один раз
+    start_time_str = ""
+    next_run = get_next_run_time(event['event_type'], event.get('event_date'), event.get('weekday'), event.get('event_time'), event.get('last_run'))
+    if next_run:
+        # Явно указываем пояс MSK в тексте
+        start_time_str = f"\n🕒 Начало: {next_run.strftime('%d.%m.%Y в %H:%M')} ({MSK_LABEL})"
+
+    notification_text = (
+        f"▶️ <b>Начинается событие: «{event_name}»</b>\n"
+        f"🔗 Ссылка для подключения: {event['link']}{start_time_str}\n\n"
+        f"С вашего счета списано {format_amount(fee)} {CURRENCY_SYMBOL} за участие."
+    )
+
     logger.info(f"Successfully processed payments for event {event['id']}.")
 
+    # Рассылка может идти долго — не держим ради нее задачу планировщика
+    run_in_background(_broadcast_event_notifications(
+        bot, event['id'], telegram_ids, notification_text
+    ))
+
+async def _broadcast_event_notifications(bot: Bot, event_id: int, telegram_ids: list[int], text: str):
+    """Фоновая рассылка уведомлений о списании за событие."""
+    await asyncio.gather(*(
+        _send(bot, telegram_id, text, "Failed to send payment notification to user")
+        for telegram_id in telegram_ids
+    ), return_exceptions=True)
+    logger.info(f"Payment notifications for event {event_id} sent to {len(telegram_ids)} users.")
+
 async def handle_reminders_for_event(bot: Bot, event: dict):
     """Отправляет напоминания подписчикам события."""
     if not event['reminder_text']:
         return
 
     async with db.pool.connection() as conn:
-        async with conn.cursor(row_factory=dict_row) as cur:
-            if event['activity_id'] == 1:
-                await cur.execute("SELECT telegram_id FROM users WHERE telegram_id != 0")
-            else:
-                await cur.execute("""
-                    SELECT u.telegram_id FROM users u
-                    JOIN user_subscriptions us ON u.id = us.user_id
-                    WHERE us.activity_id = %s
-                """, (event['activity_id'],))
-            subscribers = await cur.fetchall()
-
-    if not subscribers:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT telegram_id FROM v_activity_members WHERE activity_id = %s",
+                (event['activity_id'],), prepare=True
+            )
+            telegram_ids = [row[0] for row in await cur.fetchall()]
+
+    if not telegram_ids:
         return
 
-    logger.info(f"Sending reminders to {len(subscribers)} users for event '{event['name'] or event['activity_name']}'.")
+    logger.info(f"Sending reminders to {len(telegram_ids)} users for event '{event['name'] or event['activity_name']}'.")
     
     event_name = event['name'] or event['activity_name']
     event_description = event['description'] or event['activity_description']
@@ -192,7 +299,7 @@ async def handle_reminders_for_event(bot: Bot, event: dict):
     
     reminder_text = event['reminder_text']
     if reminder_text == ".":
-        reminder_text = await db.get_setting('default_reminder_text', DEFAULT_REMINDER_TEXT)
+        reminder_text = await db.get_setting_cached('default_reminder_text', DEFAULT_REMINDER_TEXT)
 
     # Добавляем (MSK) в форматированные поля
     try:
@@ -210,11 +317,10 @@ async def handle_reminders_for_event(bot: Bot, event: dict):
         logger.error(f"Invalid placeholder in reminder text for event {event['id']}: {e}")
         formatted_text = f"Скоро начнется событие {event_name}"
 
-    for user_row in subscribers:
-        try:
-            await bot.send_message(user_row['telegram_id'], formatted_text, parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"Failed to send reminder to {user_row['telegram_id']} for event {event['id']}: {e}")
+    await asyncio.gather(*(
+        _send(bot, telegram_id, formatted_text, f"Failed to send reminder for event {event['id']} to")
+        for telegram_id in telegram_ids
+    ), return_exceptions=True)
 
 async def process_demurrage(bot: Bot):
     """
@@ -222,14 +328,37 @@ async def process_demurrage(bot: Bot):
     Планируется в main.setup_scheduler на 00:01 по MSK.
     """
     logger.info("Checking daily demurrage process...")
-    
-    is_enabled = await db.get_setting('demurrage_enabled', '0') == '1'
+
+    # Сессионная advisory-блокировка держится на этом соединении всё время задачи:
+    # второй экземпляр бота (или повторный запуск) просто пропустит этот прогон
+    async with db.pool.connection() as conn:
+        cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (DEMURRAGE_LOCK_KEY,))
+        acquired = (await cur.fetchone())[0]
+        # Завершаем неявную транзакцию — сама блокировка сессионная и остается за соединением
+        await conn.commit()
+        if not acquired:
+            logger.info("Demurrage is already running in another session. Skipping.")
+            return
+
+        try:
+            await _run_demurrage(conn)
+        finally:
+            # После ошибки соединение может остаться в прерванной транзакции — иначе unlock не выполнится
+            # и блокировка останется за соединением в пуле
+            if conn.info.transaction_status == TransactionStatus.INERROR:
+                await conn.rollback()
+            await conn.execute("SELECT pg_advisory_unlock(%s)", (DEMURRAGE_LOCK_KEY,))
+            await conn.commit()
+
+async def _run_demurrage(conn: AsyncConnection):
+    """Проверяет настройки и интервал и списывает демерредж. Вызывается под advisory-блокировкой."""
+    is_enabled = await db.get_setting_cached('demurrage_enabled', '0') == '1'
     if not is_enabled:
         logger.info("Demurrage is disabled. Skipping.")
         return
 
     try:
-        interval_str = await db.get_setting('demurrage_interval_days', '1')
+        interval_str = await db.get_setting_cached('demurrage_interval_days', '1')
         interval = int(interval_str)
         last_run_str = await db.get_setting('demurrage_last_run', '1970-01-01')
         last_run_date = datetime.strptime(last_run_str, '%Y-%m-%d').date()
@@ -242,7 +371,7 @@ async def process_demurrage(bot: Bot):
             
         logger.info("Demurrage interval passed. Starting process...")
         
-        rate_str = await db.get_setting('demurrage_rate', '0.01')
+        rate_str = await db.get_setting_cached('demurrage_rate', '0.01')
         rate = Decimal(rate_str)
         if rate <= 0:
             logger.info(f"Demurrage rate is zero or negative ({rate}). Skipping.")
@@ -252,38 +381,89 @@ async def process_demurrage(bot: Bot):
         return
 
     try:
-        async with db.pool.connection() as conn:
+        taxed_count, total_demurrage = await _apply_demurrage(conn, rate)
+        invalidate_user()
+        if not taxed_count:
+            logger.info("No users with positive balance found. Demurrage process finished.")
+            return
+        logger.info(f"Demurrage successfully processed for {taxed_count} users. Total amount: {format_amount(total_demurrage)} {CURRENCY_SYMBOL}.")
+    except Exception as e:
+        logger.error(f"An error occurred during demurrage process. Transaction rolled back. Error: {e}", exc_info=True)
+
+async def _apply_demurrage(conn: AsyncConnection, rate: Decimal) -> tuple[int, Decimal]:
+    """
+    Списывает демерредж со всех положительных балансов пачками по DEMURRAGE_BATCH_SIZE пользователей.
+    Каждая пачка — отдельная короткая транзакция, поэтому пополнения и переводы не ждут весь прогон.
+    Строки, занятые в этот момент другими транзакциями, пропускаются (SKIP LOCKED) и добираются вторым проходом.
+
+    Returns:
+        Кортеж (количество обработанных пользователей, общая сумма демерреджа).
+    """
+    fund_user_id = 0
+    comment = f"Демерредж {rate*100}%"
+    # Пользователи, с которых уже списан демерредж за сегодня, не облагаются повторно —
+    # это защищает и второй проход, и перезапуск после сбоя посреди прогона
+    day_start = datetime.now(MOSCOW_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    params = {'fund_id': fund_user_id, 'rate': rate, 'comment': comment, 'since': day_start, 'batch': DEMURRAGE_BATCH_SIZE}
+
+    taxed_count = 0
+    total_demurrage = Decimal('0')
+    for _ in range(2):
+        after_id = 0
+        while True:
             async with conn.transaction():
-                async with conn.cursor(row_factory=dict_row) as cur:
-                    await cur.execute("SELECT id, balance FROM users WHERE balance > 0 AND telegram_id != 0")
-                    users_to_tax = await cur.fetchall()
+                async with conn.cursor() as cur:
+                    await cur.execute("""
+                        WITH to_tax AS (
+                            -- Банковское округление до 4 знаков, как прежний Decimal.quantize (ROUND_HALF_EVEN):
+                            -- round() в PostgreSQL округляет половину от нуля. Сумма положительна, поэтому
+                            -- mod(x * 10000, 2) = 0.5 означает ровно половину при четной последней цифре — ее отбрасываем
+                            SELECT id,
+                                CASE WHEN mod(balance * %(rate)s * 10000, 2) = 0.5
+                                    THEN trunc(balance * %(rate)s, 4)
+                                    ELSE round(balance * %(rate)s, 4)
+                                END AS amount
+                            FROM users u
+                            WHERE balance > 0 AND telegram_id != 0 AND id > %(after_id)s
+                              AND NOT EXISTS (
+                                  SELECT 1 FROM transactions t
+                                  WHERE t.from_user_id = u.id AND t.type = 'demurrage' AND t.created_at >= %(since)s
+                              )
+                            ORDER BY id
+                            LIMIT %(batch)s
+                            FOR UPDATE SKIP LOCKED
+                        ), taxed AS (
+                            UPDATE users u SET balance = u.balance - t.amount
+                            FROM to_tax t
+                            WHERE u.id = t.id AND t.amount > 0
+                            RETURNING u.id, t.amount
+                        ), inserted AS (
+                            INSERT INTO transactions (from_user_id, to_user_id, amount, type, comment)
+                            SELECT id, %(fund_id)s, amount, 'demurrage', %(comment)s FROM taxed
+                            RETURNING amount
+                        ), fund AS (
+                            -- Зачисление в фонд в том же запросе; строка фонда (telegram_id = 0) в to_tax не попадает
+                            UPDATE users SET balance = balance + (SELECT sum(amount) FROM inserted)
+                            WHERE id = %(fund_id)s AND EXISTS (SELECT 1 FROM inserted)
+                        )
+                        SELECT
+                            (SELECT max(id) FROM to_tax),
+                            (SELECT count(*) FROM inserted),
+                            (SELECT COALESCE(sum(amount), 0) FROM inserted)
+                    """, {**params, 'after_id': after_id})
+                    last_id, batch_count, batch_total = await cur.fetchone()
 
-                if not users_to_tax:
-                    logger.info("No users with positive balance found. Demurrage process finished.")
-                    await db.set_setting('demurrage_last_run', date.today().isoformat())
-                    return
+            if last_id is None:
+                break
+            after_id = last_id
+            taxed_count += batch_count
+            total_demurrage += batch_total
 
-                total_demurrage = Decimal('0')
-                fund_user_id = 0
-                for user in users_to_tax:
-                    user_id = user['id']
-                    balance = user['balance']
-                    demurrage_amount = (balance * rate).quantize(Decimal('0.0001'))
-                    if demurrage_amount <= 0: 
-                        continue
-                    
-                    await conn.execute("UPDATE users SET balance = balance - %s WHERE id = %s", (demurrage_amount, user_id))
-                    await conn.execute(
-                        "INSERT INTO transactions (from_user_id, to_user_id, amount, type, comment) VALUES (%s, %s, %s, 'demurrage', %s)",
-                        (user_id, fund_user_id, demurrage_amount, f"Демерредж {rate*100}%")
-                    )
-                    total_demurrage += demurrage_amount
-                
-                if total_demurrage > 0:
-                    await conn.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (total_demurrage, fund_user_id))
-                
-                await db.set_setting('demurrage_last_run', date.today().isoformat())
-                
-        logger.info(f"Demurrage successfully processed for {len(users_to_tax)} users. Total amount: {format_amount(total_demurrage)} {CURRENCY_SYMBOL}.")
-    except Exception as e:
-        logger.error(f"An error occurred during demurrage process. Transaction rolled back. Error: {e}", exc_info=True)
+    # Отметка о запуске пишется на том же соединении, что держит advisory-блокировку
+    async with conn.transaction():
+        await conn.execute(
+            "INSERT INTO settings (key, value) VALUES ('demurrage_last_run', %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+            (date.today().isoformat(),)
+        )
+
+    return taxed_count, total_demurrage
@@ -2,33 +2,77 @@
 # v1.5.3 - 2025-08-16
 import logging
 import asyncio
+import hmac
+import json
 from decimal import Decimal
+from functools import lru_cache
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 from app.database import db
-from app.utils import format_amount, ensure_user_exists, is_user_in_group
+from app.utils import format_amount, invalidate_user, is_user_in_group, quantize_amount, run_in_background
 from config import WEBHOOK_HOST, WEBHOOK_PORT, TRIBUTE_WEBHOOK_SECRET
 
 logger = logging.getLogger(__name__)
 
+# Секрет кодируется один раз при импорте, а не на каждый запрос
+SECRET_BYTES = (TRIBUTE_WEBHOOK_SECRET or '').encode()
+
+# Сначала проводка: если платеж с таким external_id уже зачислен, INSERT ничего не вернет
+# и баланс не изменится. Сброс grace_credit_used повторяет db.handle_debt_repayment
+TOP_UP_SQL = """
+    WITH tx AS (
+        INSERT INTO transactions (from_user_id, to_user_id, amount, type, comment, external_id)
+        VALUES (0, %s, %s, 'top_up', %s, %s)
+        ON CONFLICT (external_id) DO NOTHING
+        RETURNING to_user_id, amount
+    )
+    UPDATE users u SET
+        balance = u.balance + tx.amount,
+        grace_credit_used = u.grace_credit_used AND u.balance + tx.amount < 0
+    FROM tx
+    WHERE u.id = tx.to_user_id
+    RETURNING u.id
+"""
+
+@lru_cache(maxsize=8)
+def _parse_rate(rate_str: str) -> Decimal:
+    """Курс меняется редко: строка из кэша настроек разбирается в Decimal один раз."""
+    return Decimal(rate_str)
+
 async def handle_tribute_webhook(request: web.Request):
     """Обработка вебхука от Tribute для пополнения баланса."""
     bot = request.app['bot']
     
-    if request.headers.get('X-Tribute-Secret') != TRIBUTE_WEBHOOK_SECRET:
+    # Без настроенного секрета подлинность запроса проверить нельзя — отклоняем любой вебхук
+    if not SECRET_BYTES:
+        logger.error("TRIBUTE_WEBHOOK_SECRET is not configured; rejecting Tribute webhook.")
+        return web.Response(status=403)
+
+    # Сравнение за постоянное время, чтобы секрет нельзя было подобрать по времени ответа
+    received_secret = request.headers.get('X-Tribute-Secret', '').encode()
+    if not hmac.compare_digest(received_secret, SECRET_BYTES):
         logger.warning("Received webhook with invalid secret.")
         return web.Response(status=403)
 
     try:
-        data = await request.json()
+        raw_body = await request.read()
+        try:
+            # parse_float=Decimal: сумма сразу приходит точной, без промежуточного float
+            data = json.loads(raw_body, parse_float=Decimal)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.warning("Received webhook with malformed JSON body.")
+            return web.Response(status=400)
         logger.info(f"Received Tribute webhook: {data}")
 
         payer_info = data.get('payer', {})
         telegram_id = payer_info.get('telegram_id')
         username = payer_info.get('username')
         amount_rub = Decimal(str(data.get('amount')))
+        # Tribute повторяет вебхук при ошибке или таймауте — ID платежа не дает зачислить его дважды
+        external_id = data.get('id') or data.get('payment_id')
+        external_id = str(external_id) if external_id is not None else None
         
         if not telegram_id or not amount_rub:
             logger.error(f"Invalid data in webhook: {data}")
@@ -38,38 +82,41 @@ async def handle_tribute_webhook(request: web.Request):
             logger.warning(f"User {telegram_id} from webhook is not in the main group.")
             return web.Response(status=200, text="OK (user not in group)")
 
-        await ensure_user_exists(telegram_id, username)
-        
-        exchange_rate_str = await db.get_setting('exchange_rate', '1.0')
-        exchange_rate = Decimal(exchange_rate_str)
-        top_up_amount = (amount_rub * exchange_rate).quantize(Decimal('0.0001'))
-        user_id = None
+        exchange_rate = _parse_rate(await db.get_setting_cached('exchange_rate', '1.0'))
+        top_up_amount = quantize_amount(amount_rub * exchange_rate)
 
         async with db.pool.connection() as conn:
             async with conn.transaction():
-                user_row = await conn.execute("SELECT id FROM users WHERE telegram_id = %s", (telegram_id,)).fetchone()
-                if not user_row:
-                    logger.error(f"User {telegram_id} not found in DB after ensure_user_exists call.")
-                    raise Exception("User not found during webhook processing")
-
-                user_id = user_row[0]
-                await conn.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (top_up_amount, user_id))
-                await conn.execute(
-                    "INSERT INTO transactions (from_user_id, to_user_id, amount, type, comment) VALUES (0, %s, %s, 'top_up', %s)",
-                    (user_id, top_up_amount, f"Пополнение через Tribute на {amount_rub} RUB")
+                # Один UPSERT вместо ensure_user_exists + SELECT id; (xmax = 0) истинно только для новой строки
+                cur = await conn.execute("""
+                    INSERT INTO users (telegram_id, username) VALUES (%s, %s)
+                    ON CONFLICT (telegram_id) DO UPDATE SET username = COALESCE(EXCLUDED.username, users.username)
+                    RETURNING id, (xmax = 0) AS inserted
+                """, (telegram_id, username.lower() if username else None))
+                user_id, is_new_user = await cur.fetchone()
+                if is_new_user:
+                    # Как и db.create_user, подписываем нового пользователя на «Общие события»
+                    await conn.execute(
+                        "INSERT INTO user_subscriptions (user_id, activity_id) VALUES (%s, 1) ON CONFLICT DO NOTHING",
+                        (user_id,)
+                    )
+                    logger.info(f"New user created from Tribute webhook: {username or telegram_id}")
+
+                # Проводка, зачисление и сброс кредитного лимита — одним запросом
+                cur = await conn.execute(
+                    TOP_UP_SQL,
+                    (user_id, top_up_amount, f"Пополнение через Tribute на {amount_rub} RUB", external_id)
                 )
+                is_duplicate = await cur.fetchone() is None
+
+        if is_duplicate:
+            logger.info(f"Tribute payment {external_id} for user {telegram_id} was already processed. Skipping.")
+            return web.Response(status=200, text="OK (duplicate)")
         
-        if user_id:
-            await db.handle_debt_repayment(user_id)
+        invalidate_user(telegram_id)
 
-        try:
-            await bot.send_message(
-                telegram_id,
-                f"✅ Ваш баланс пополнен на <b>{format_amount(top_up_amount)} Ӫ</b> "
-                f"после оплаты {amount_rub} RUB через Tribute."
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify user {telegram_id} about top-up: {e}")
+        # Отвечаем Tribute сразу после записи в БД, не дожидаясь ответа Telegram API
+        run_in_background(_notify_top_up(bot, telegram_id, top_up_amount, amount_rub))
 
         return web.Response(status=200, text="OK")
 
@@ -77,8 +124,22 @@ async def handle_tribute_webhook(request: web.Request):
         logger.exception(f"Error processing Tribute webhook: {e}")
         return web.Response(status=500)
 
-async def run_webhook_server(bot: Bot, dp: Dispatcher):
-    """Запускает веб-сервер для приема вебхуков от Telegram и Tribute."""
+async def _notify_top_up(bot: Bot, telegram_id: int, top_up_amount: Decimal, amount_rub: Decimal):
+    """Уведомляет пользователя о пополнении; ошибки только логируются."""
+    try:
+        await bot.send_message(
+            telegram_id,
+            f"✅ Ваш баланс пополнен на <b>{format_amount(top_up_amount)} Ӫ</b> "
+            f"после оплаты {amount_rub} RUB через Tribute."
+        )
+    except Exception as e:
+        logger.error(f"Failed to notify user {telegram_id} about top-up: {e}")
+
+async def run_webhook_server(bot: Bot, dp: Dispatcher, stop_event: asyncio.Event | None = None):
+    """
+    Запускает веб-сервер для приема вебхуков от Telegram и Tribute.
+    Работает до установки stop_event, после чего корректно останавливает сервер.
+    """
     app = web.Application()
     app['bot'] = bot
     
@@ -91,12 +152,17 @@ async def run_webhook_server(bot: Bot, dp: Dispatcher):
     
     setup_application(app, dp, bot=bot)
     
-    runner = web.AppRunner(app)
+    # Access-лог aiohttp отключен: значимые события вебхуков и так логируются обработчиками
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
     
     logger.info(f"Starting aiohttp server on {WEBHOOK_HOST}:{WEBHOOK_PORT}...")
     await site.start()
     
-    # This will run forever until interrupted
-    await asyncio.Event().wait()
+    stop_event = stop_event or asyncio.Event()
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Stopping aiohttp server...")
+        await runner.cleanup()
@@ -1,8 +1,12 @@
 # XBalanseBot/app/utils.py
 # v1.5.6 - 2025-08-17 (fix recurring same-day logic: return today if time hasn't passed)
+import asyncio
 import logging
+import time as _time
+from collections import OrderedDict
 from datetime import datetime, timedelta, time
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_EVEN
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 from aiogram import Bot
 from config import MAIN_GROUP_ID, CURRENCY_SYMBOL
@@ -12,6 +16,74 @@ logger = logging.getLogger(__name__)
 
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
+# Кэш недавно проверенных пользователей для ensure_user_exists: telegram_id -> (время проверки, username)
+_SEEN_USERS_TTL = 600
+_SEEN_USERS_MAX_SIZE = 10_000
+_seen_users: "OrderedDict[int, tuple[float, str | None]]" = OrderedDict()
+
+# Короткоживущий кэш строк users для частых проверок (баланс, счётчик, права): telegram_id -> (время, строка)
+_USER_CACHE_TTL = 5
+_USER_CACHE_MAX_SIZE = 4096
+_user_cache: "OrderedDict[int, tuple[float, dict]]" = OrderedDict()
+# Счетчик сбросов кэша: строка, прочитанная до сброса, не должна попасть в кэш после него
+_user_cache_epoch = 0
+
+# Кэш членства в основной группе: telegram_id -> (время проверки, состоит ли в группе)
+_MEMBER_CACHE_TTL = 60
+_MEMBER_CACHE_MAX_SIZE = 10_000
+_member_cache: "OrderedDict[int, tuple[float, bool]]" = OrderedDict()
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+_background_tasks: set[asyncio.Task] = set()
+# Сколько секунд при остановке ждать незавершенные фоновые задачи
+BACKGROUND_DRAIN_TIMEOUT = 30
+
+# Масштаб денежных колонок в БД: NUMERIC(18, 4)
+AMOUNT_QUANTUM = Decimal('0.0001')
+
+def quantize_amount(amount: Decimal) -> Decimal:
+    """
+    Приводит сумму к масштабу денежных колонок БД (4 знака после запятой).
+
+    Нормализуем один раз при вводе, чтобы дальнейшая арифметика и запись в БД
+    работали с коротким коэффициентом, а не с произвольно длинным вводом пользователя.
+
+    Raises:
+        InvalidOperation: Если сумма не является конечным числом или слишком велика.
+    """
+    return amount.quantize(AMOUNT_QUANTUM, rounding=ROUND_HALF_EVEN)
+
+def run_in_background(coro) -> asyncio.Task:
+    """
+    Запускает корутину как фоновую задачу, не дожидаясь её завершения.
+    Исключения задачи логируются, а ссылка на неё хранится до окончания работы.
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+async def drain_background_tasks(timeout: float = BACKGROUND_DRAIN_TIMEOUT):
+    """
+    Дожидается завершения фоновых задач (например, рассылки уведомлений о списании) при остановке бота.
+    Задачи, не успевшие завершиться за timeout секунд, отменяются.
+    """
+    pending = set(_background_tasks)
+    if not pending:
+        return
+    logger.info(f"Waiting for {len(pending)} background tasks to finish...")
+    _, not_done = await asyncio.wait(pending, timeout=timeout)
+    if not_done:
+        logger.warning(f"{len(not_done)} background tasks did not finish in {timeout}s and will be cancelled.")
+        for task in not_done:
+            task.cancel()
+        await asyncio.gather(*not_done, return_exceptions=True)
+
+def _on_background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task {task.get_name()} failed: {task.exception()}", exc_info=task.exception())
+
 def format_amount(amount: Decimal) -> str:
     """
     Форматирует сумму для вывода, убирая лишние нули и избегая научной нотации.
@@ -24,7 +96,11 @@ def format_amount(amount: Decimal) -> str:
     """
     if amount is None:
         return "0"
-    
+    return _format_amount_cached(amount)
+
+@lru_cache(maxsize=4096)
+def _format_amount_cached(amount: Decimal) -> str:
+    """Кэшированное форматирование: в истории одни и те же суммы (взносы, переводы) повторяются постоянно."""
     s = f'{amount:f}'
     
     if '.' in s:
@@ -37,7 +113,7 @@ def format_transactions_history(transactions: list, user_db_id: int) -> str:
     Форматирует список транзакций в текстовый отчет по категориям.
 
     Args:
-        transactions (list): Список транзакций (объекты sqlite3.Row).
+        transactions (list): Список транзакций (строки dict_row).
         user_db_id (int): ID пользователя в БД, для которого строится отчет.
 
     Returns:
@@ -45,63 +121,122 @@ def format_transactions_history(transactions: list, user_db_id: int) -> str:
     """
     response_parts = []
     top_ups, incoming, outgoing, system_debits = [], [], [], []
+    # (направление, тип транзакции) -> раздел отчета; один поиск в словаре на строку
+    buckets = {
+        ('in', 'manual_add'): top_ups,
+        ('in', 'welcome_bonus'): top_ups,
+        ('in', 'top_up'): top_ups,
+        ('in', 'transfer'): incoming,
+        ('in', 'fund_payment'): incoming,
+        ('out', 'transfer'): outgoing,
+        ('out', 'event_fee'): outgoing,
+        ('out', 'demurrage'): system_debits,
+        ('out', 'manual_rem'): system_debits,
+    }
 
     for tx in transactions:
         if tx['to_user_id'] == user_db_id:
-            if tx['type'] in ('manual_add', 'welcome_bonus', 'top_up'):
-                top_ups.append(tx)
-            elif tx['type'] in ('transfer', 'fund_payment'):
-                incoming.append(tx)
+            direction = 'in'
         elif tx['from_user_id'] == user_db_id:
-            if tx['type'] in ('transfer', 'event_fee'):
-                outgoing.append(tx)
-            elif tx['type'] in ('demurrage', 'manual_rem'):
-                system_debits.append(tx)
-
-    def format_tx_line(tx, sign, prefix="", peer_name=""):
-        date_str = tx['created_at'].strftime('%d.%m %H:%M')
-        amount_str = format_amount(Decimal(str(tx['amount'])))
-        comment = f" ({tx['comment']})" if tx['comment'] else ""
-        return f"  {sign} {amount_str} {prefix}{peer_name}{comment} - {date_str}\n"
+            direction = 'out'
+        else:
+            continue
+        bucket = buckets.get((direction, tx['type']))
+        if bucket is not None:
+            bucket.append(tx)
 
+    # Строки собираются списковыми включениями без вызова вложенной функции на каждую транзакцию
     if top_ups:
         response_parts.append("\n\n💰 <b>Пополнения:</b>\n")
-        for tx in top_ups:
-            response_parts.append(format_tx_line(tx, "✅ +"))
+        response_parts.extend(
+            f"  ✅ + {format_amount(tx['amount'])} {' (' + tx['comment'] + ')' if tx['comment'] else ''} - {tx['created_at']:%d.%m %H:%M}\n"
+            for tx in top_ups
+        )
     
     if incoming:
         response_parts.append("\n📥 <b>Входящие переводы:</b>\n")
-        for tx in incoming:
-            peer = f"@{tx['sender_username']}" if tx['sender_username'] else "Пользователь"
-            response_parts.append(format_tx_line(tx, "➕", prefix="от ", peer_name=peer))
+        response_parts.extend(
+            f"  ➕ {format_amount(tx['amount'])} от {'@' + tx['sender_username'] if tx['sender_username'] else 'Пользователь'}"
+            f"{' (' + tx['comment'] + ')' if tx['comment'] else ''} - {tx['created_at']:%d.%m %H:%M}\n"
+            for tx in incoming
+        )
 
     if outgoing:
         response_parts.append("\n📤 <b>Исходящие переводы и платежи:</b>\n")
-        for tx in outgoing:
-            peer = f"@{tx['recipient_username']}" if tx['recipient_username'] != 'fund' else "Фонд"
-            response_parts.append(format_tx_line(tx, "➖ -", peer_name=peer))
+        response_parts.extend(
+            f"  ➖ - {format_amount(tx['amount'])} {'@' + str(tx['recipient_username']) if tx['recipient_username'] != 'fund' else 'Фонд'}"
+            f"{' (' + tx['comment'] + ')' if tx['comment'] else ''} - {tx['created_at']:%d.%m %H:%M}\n"
+            for tx in outgoing
+        )
 
     if system_debits:
         response_parts.append("\n💸 <b>Системные списания:</b>\n")
-        for tx in system_debits:
-            peer = "Техническое списание" if tx['type'] == 'manual_rem' else "Демерредж"
-            response_parts.append(format_tx_line(tx, "➖ -", peer_name=peer))
+        response_parts.extend(
+            f"  ➖ - {format_amount(tx['amount'])} {'Техническое списание' if tx['type'] == 'manual_rem' else 'Демерредж'}"
+            f"{' (' + tx['comment'] + ')' if tx['comment'] else ''} - {tx['created_at']:%d.%m %H:%M}\n"
+            for tx in system_debits
+        )
             
     return "".join(response_parts)
 
+# Начиная с этого размера история форматируется в отдельном потоке, чтобы не блокировать event loop
+_HISTORY_OFFLOAD_THRESHOLD = 100
+
+async def format_transactions_history_async(transactions: list, user_db_id: int) -> str:
+    """
+    То же, что format_transactions_history, но длинные истории форматируются
+    в отдельном потоке через asyncio.to_thread.
+    """
+    if len(transactions) > _HISTORY_OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(format_transactions_history, transactions, user_db_id)
+    return format_transactions_history(transactions, user_db_id)
+
+async def _cached_user(telegram_id: int) -> dict | None:
+    """
+    Возвращает строку пользователя из кэша, если она моложе _USER_CACHE_TTL секунд,
+    иначе читает её из БД. Отсутствующие пользователи не кэшируются.
+    Для проверок перед списанием средств не используется — там нужен свежий баланс.
+    """
+    now = _time.monotonic()
+    cached = _user_cache.get(telegram_id)
+    if cached and now - cached[0] < _USER_CACHE_TTL:
+        return cached[1]
+
+    epoch = _user_cache_epoch
+    user = await db.get_user(telegram_id=telegram_id)
+    # Пока шел запрос, данные могли измениться и кэш был сброшен — тогда прочитанная строка уже устарела
+    if user and epoch == _user_cache_epoch:
+        _user_cache[telegram_id] = (now, user)
+        _user_cache.move_to_end(telegram_id)
+        while len(_user_cache) > _USER_CACHE_MAX_SIZE:
+            _user_cache.popitem(last=False)
+    return user
+
+def invalidate_user(telegram_id: int | None = None):
+    """
+    Сбрасывает кэш строки пользователя после изменения баланса, username или прав.
+    Без аргумента очищает кэш целиком (массовые списания планировщика).
+    """
+    global _user_cache_epoch
+    _user_cache_epoch += 1
+    if telegram_id is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(telegram_id, None)
+
 async def get_user_balance(telegram_id: int) -> Decimal:
     """Получает баланс пользователя."""
-    user = await db.get_user(telegram_id=telegram_id)
-    return Decimal(str(user['balance'])) if user else Decimal('0')
+    user = await _cached_user(telegram_id)
+    return user['balance'] if user else Decimal('0')
 
 async def get_transaction_count(telegram_id: int) -> int:
     """Получает количество транзакций пользователя."""
-    user = await db.get_user(telegram_id=telegram_id)
+    user = await _cached_user(telegram_id)
     return user['transaction_count'] if user else 0
 
 async def is_admin(telegram_id: int) -> bool:
     """Проверяет, является ли пользователь администратором."""
-    user = await db.get_user(telegram_id=telegram_id)
+    user = await _cached_user(telegram_id)
     return bool(user['is_admin']) if user else False
 
 async def is_user_in_group(bot: Bot, telegram_id: int) -> bool:
@@ -110,14 +245,32 @@ async def is_user_in_group(bot: Bot, telegram_id: int) -> bool:
     """
     if telegram_id == 0:
         return True
+
+    # Результат недавней проверки берём из кэша, чтобы не ходить в Telegram API на каждый вебхук
+    now = _time.monotonic()
+    cached = _member_cache.get(telegram_id)
+    if cached and now - cached[0] < _MEMBER_CACHE_TTL:
+        _member_cache.move_to_end(telegram_id)
+        return cached[1]
         
     try:
         member = await bot.get_chat_member(MAIN_GROUP_ID, telegram_id)
-        return member.status in ['member', 'administrator', 'creator']
+        is_member = member.status in ['member', 'administrator', 'creator']
     except Exception as e:
+        # Ошибки API не кэшируем: следующая проверка повторит запрос
         logger.warning(f"Could not check user {telegram_id} in group {MAIN_GROUP_ID}: {e}")
         return False
 
+    _member_cache[telegram_id] = (now, is_member)
+    _member_cache.move_to_end(telegram_id)
+    while len(_member_cache) > _MEMBER_CACHE_MAX_SIZE:
+        _member_cache.popitem(last=False)
+    return is_member
+
+def invalidate_group_membership(telegram_id: int):
+    """Сбрасывает закэшированный статус членства, например при вступлении пользователя в группу."""
+    _member_cache.pop(telegram_id, None)
+
 async def ensure_user_exists(telegram_id: int, username: str | None, is_bot: bool = False) -> bool:
     """
     Проверяет существование пользователя и создает его, если он отсутствует.
@@ -128,19 +281,39 @@ async def ensure_user_exists(telegram_id: int, username: str | None, is_bot: boo
         logger.info(f"Ignored attempt to register a bot with id {telegram_id}")
         return False
 
+    # Пользователь уже проверялся недавно с тем же username — повторный запрос к БД не нужен
+    now = _time.monotonic()
+    seen = _seen_users.get(telegram_id)
+    if seen and now - seen[0] < _SEEN_USERS_TTL and seen[1] == username:
+        _seen_users.move_to_end(telegram_id)
+        return False
+
     user = await db.get_user(telegram_id=telegram_id)
     
     if not user:
         await db.create_user(telegram_id, username)
+        invalidate_user(telegram_id)
         logger.info(f"New user created: {username or telegram_id}")
+        _remember_seen_user(telegram_id, username, now)
         return True
     
-    if username and (not user['username'] or user['username'] != username.lower()):
-        await db.update_user_username(telegram_id, username)
-        logger.info(f"Username for user {telegram_id} updated to {username.lower()}")
+    # Приводим к нижнему регистру один раз: в БД username хранится в нижнем регистре
+    normalized = username.lower() if username else None
+    if normalized and user['username'] != normalized:
+        await db.update_user_username(telegram_id, normalized)
+        invalidate_user(telegram_id)
+        logger.info(f"Username for user {telegram_id} updated to {normalized}")
 
+    _remember_seen_user(telegram_id, username, now)
     return False
 
+def _remember_seen_user(telegram_id: int, username: str | None, seen_at: float):
+    """Запоминает проверенного пользователя, вытесняя самые старые записи при переполнении."""
+    _seen_users[telegram_id] = (seen_at, username)
+    _seen_users.move_to_end(telegram_id)
+    while len(_seen_users) > _SEEN_USERS_MAX_SIZE:
+        _seen_users.popitem(last=False)
+
 def get_next_run_time(
     event_type: str, 
     event_date: datetime | None, 
@@ -168,18 +341,17 @@ def get_next_run_time(
         return None
 
     if event_type == 'recurring' and weekday is not None and event_time is not None:
-        today_weekday = now.weekday()
-        days_ahead = weekday - today_weekday
-
-        if days_ahead < 0:
-            days_ahead += 7
-        elif days_ahead == 0:
-            # Сегодня нужный день: если текущее время уже прошло — переносим на следующую неделю
-            if now.time() >= event_time:
-                days_ahead = 7
-
-        target_date = now.date() + timedelta(days=days_ahead)
-        target_dt = datetime.combine(target_date, event_time).replace(tzinfo=MOSCOW_TZ)
-        return target_dt
+        days_ahead = (weekday - now.weekday()) % 7
+        # Сегодня нужный день: если текущее время уже прошло — переносим на следующую неделю
+        if days_ahead == 0 and now.time() >= event_time:
+            days_ahead = 7
+
+        # Собираем дату из чисел сразу с tzinfo, без date() + combine() + replace()
+        target_dt = datetime(
+            now.year, now.month, now.day,
+            event_time.hour, event_time.minute, event_time.second, event_time.microsecond,
+            tzinfo=MOSCOW_TZ
+        )
+        return target_dt + timedelta(days=days_ahead) if days_ahead else target_dt
 
     return None
\ No newline at end of file
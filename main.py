@@ -3,9 +3,12 @@
 import asyncio
 import logging
 import os
-import sys
+import queue
+import signal
 import subprocess
-from datetime import datetime
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 
 # Загрузка .env в самом начале скрипта для локальной разработки
@@ -22,39 +25,109 @@ from apscheduler.triggers.cron import CronTrigger
 # Set asyncio policy for Windows compatibility with psycopg3
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+else:
+    # uvloop (libuv) быстрее стандартного цикла на сетевом вводе-выводе; без него работаем на стандартном
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
 from config import BOT_TOKEN, SUPER_ADMIN_ID, DEV_MODE, WEBHOOK_HOST
 from app.database import db
 from app.handlers import common, user_commands, admin_commands, activity_handlers, event_handlers
 from app.services import scheduler_jobs
+from app.utils import drain_background_tasks
 # ИЗМЕНЕНИЕ: Импортируем функцию для запуска веб-сервера
 from app.services.webhook_handler import run_webhook_server
 
 # Настройка логирования
 log_dir = "data/logs"
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-log_filename = os.path.join(log_dir, f"bot_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+os.makedirs(log_dir, exist_ok=True)
+
+# Время в имени файла в UTC: одинаковые имена независимо от часового пояса сервера
+log_filename = os.path.join(log_dir, f"bot_{datetime.now(timezone.utc):%Y-%m-%d_%H-%M-%S}.log")
+
+# Запись в файл и консоль идет в отдельном потоке QueueListener:
+# вызов logger.* в обработчиках только кладет запись в очередь и не блокирует event loop
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler(log_filename, encoding='utf-8')
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+log_listener.start()
+
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
 logger = logging.getLogger(__name__)
 
+# Общие настройки задач планировщика: пропущенные запуски схлопываются в один,
+# одна и та же задача не выполняется параллельно, опоздание до 5 минут допустимо
+SCHEDULER_JOB_DEFAULTS = {
+    'coalesce': True,
+    'max_instances': 1,
+    'misfire_grace_time': 300,
+}
+
+# Необязательное хранилище FSM: если задан REDIS_URL, состояния диалогов переживают перезапуск бота
+REDIS_URL = os.getenv("REDIS_URL")
+FSM_STATE_TTL = 3600
+
+def create_fsm_storage():
+    """Возвращает RedisStorage при заданном REDIS_URL, иначе MemoryStorage."""
+    if REDIS_URL:
+        # Импорт только при необходимости: пакет redis нужен лишь для этого режима
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            logger.error(f"REDIS_URL is set but the 'redis' package is not installed ({e}). Falling back to in-memory FSM storage.")
+            return MemoryStorage()
+        logger.info("Using Redis FSM storage.")
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    return MemoryStorage()
+
 async def logging_middleware(handler, event, data: dict):
+    # Если INFO отключен, не тратим время на проверки типов и форматирование
+    if not logger.isEnabledFor(logging.INFO):
+        return await handler(event, data)
     user = data.get('event_from_user')
     if user:
-        if isinstance(event, Message): logger.info(f"User {user.id} (@{user.username}) sent message: '{event.text}'")
-        elif isinstance(event, CallbackQuery): logger.info(f"User {user.id} (@{user.username}) sent callback: '{event.data}'")
-        elif isinstance(event, ChatMemberUpdated): logger.info(f"User {user.id} (@{user.username}) caused chat member update: {event.new_chat_member.status}")
+        if isinstance(event, Message): logger.info("User %s (@%s) sent message: '%s'", user.id, user.username, event.text)
+        elif isinstance(event, CallbackQuery): logger.info("User %s (@%s) sent callback: '%s'", user.id, user.username, event.data)
+        elif isinstance(event, ChatMemberUpdated): logger.info("User %s (@%s) caused chat member update: %s", user.id, user.username, event.new_chat_member.status)
     return await handler(event, data)
 
+async def stop_docker_services():
+    """Останавливает контейнеры docker compose, не блокируя event loop."""
+    logger.info("Stopping docker compose services...")
+    command = ("docker", "compose", "down")
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        returncode = process.returncode
+    except NotImplementedError:
+        # SelectorEventLoop на Windows не поддерживает подпроцессы — запускаем в отдельном потоке
+        try:
+            result = await asyncio.to_thread(subprocess.run, command, capture_output=True)
+        except FileNotFoundError as e:
+            logger.error(f"Failed to run 'docker compose down': {e}")
+            return
+        stderr, returncode = result.stderr, result.returncode
+    except FileNotFoundError as e:
+        logger.error(f"Failed to run 'docker compose down': {e}")
+        return
+
+    if returncode != 0:
+        logger.error(f"'docker compose down' exited with code {returncode}: {stderr.decode(errors='replace').strip()}")
+    else:
+        logger.info("Docker services stopped successfully.")
+
 async def setup_super_admin():
     logger.info("Checking for super admin setup...")
     if not SUPER_ADMIN_ID: return
@@ -67,10 +140,19 @@ async def setup_super_admin():
         logger.info(f"Existing user {SUPER_ADMIN_ID} has been promoted to super admin.")
 
 async def setup_scheduler(bot: Bot, scheduler: AsyncIOScheduler):
-    scheduler.add_job(scheduler_jobs.process_demurrage, CronTrigger(hour=0, minute=1), args=(bot,))
+    # Задачи держатся в MemoryJobStore: их аргументы (bot, scheduler) не сериализуются pickle,
+    # поэтому при старте они заново строятся из таблицы events. Фиксированный id защищает от дублей
+    scheduler.add_job(
+        scheduler_jobs.process_demurrage,
+        CronTrigger(hour=0, minute=1),
+        args=(bot,),
+        id="daily_demurrage",
+        replace_existing=True,
+        # Ежедневная задача: запуск с опозданием до часа лучше, чем пропуск дня
+        misfire_grace_time=3600
+    )
     all_events = await db.get_all_events()
-    for event in all_events:
-        await scheduler_jobs.schedule_event_jobs(event, bot, scheduler)
+    await scheduler_jobs.bulk_reschedule(all_events, bot, scheduler)
     scheduler.start()
     logger.info(f"Scheduler started with {len(scheduler.get_jobs())} jobs.")
 
@@ -82,7 +164,7 @@ async def main():
         logger.critical("FATAL: BOT_TOKEN is not found! Bot cannot start.")
         return
 
-    scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+    scheduler = AsyncIOScheduler(timezone="Europe/Moscow", job_defaults=SCHEDULER_JOB_DEFAULTS)
     
     bot = Bot(
         token=BOT_TOKEN,
@@ -90,10 +172,12 @@ async def main():
     )
     bot.scheduler = scheduler
     
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.message.outer_middleware(logging_middleware)
-    dp.callback_query.outer_middleware(logging_middleware)
-    dp.chat_member.outer_middleware(logging_middleware)
+    dp = Dispatcher(storage=create_fsm_storage())
+    # Журнал каждого апдейта нужен только при разработке или отладке; в продакшене middleware не подключается
+    if DEV_MODE or logger.isEnabledFor(logging.DEBUG):
+        dp.message.outer_middleware(logging_middleware)
+        dp.callback_query.outer_middleware(logging_middleware)
+        dp.chat_member.outer_middleware(logging_middleware)
     
     dp.include_router(common.router)
     dp.include_router(admin_commands.router)
@@ -102,12 +186,16 @@ async def main():
     dp.include_router(event_handlers.router)
 
     try:
-        await db.initialize()
-        await setup_super_admin()
-        await setup_scheduler(bot, scheduler)
-        
-        # Удаляем старый вебхук, чтобы избежать конфликтов
-        await bot.delete_webhook(drop_pending_updates=True)
+        # Инициализация БД и удаление старого вебхука (во избежание конфликтов) не зависят друг от друга
+        await asyncio.gather(
+            db.initialize(),
+            bot.delete_webhook(drop_pending_updates=True)
+        )
+        # Обе функции используют уже инициализированный пул и независимы между собой
+        await asyncio.gather(
+            setup_super_admin(),
+            setup_scheduler(bot, scheduler)
+        )
         
         if DEV_MODE:
             # --- РЕЖИМ ДЛЯ ЛОКАЛЬНОЙ РАЗРАБОТКИ ---
@@ -124,27 +212,33 @@ async def main():
             await bot.set_webhook(webhook_url)
             logger.info(f"Webhook set to: {webhook_url}")
             
+            # SIGTERM (остановка контейнера на Render) и SIGINT завершают сервер штатно
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, stop_event.set)
+                except NotImplementedError:
+                    # Windows: обработчики сигналов в event loop не поддерживаются
+                    pass
+
             # Запускаем веб-сервер, который будет принимать обновления от Telegram и Tribute
-            await run_webhook_server(bot, dp)
+            await run_webhook_server(bot, dp, stop_event)
             
     finally:
         if scheduler.running:
             scheduler.shutdown()
             logger.info("Scheduler stopped.")
             
-        await db.close()
-        await bot.session.close()
-        logger.info("Bot session and database pool closed.")
-        
-        # ИЗМЕНЕНИЕ: Остановка Docker-контейнера происходит только в режиме разработки
-        if DEV_MODE:
-            logger.info("Stopping docker-compose services...")
-            try:
-                subprocess.run(["docker-compose", "down"], check=True, capture_output=True)
-                logger.info("Docker services stopped successfully.")
-            except (subprocess.CalledProcessError, FileNotFoundError) as e:
-                logger.error(f"Failed to run 'docker-compose down': {e}")
+        # Рассылки уведомлений должны завершиться до закрытия сессии бота: за списания уже заплачено
+        await drain_background_tasks()
 
+        # Закрытие ресурсов и остановка Docker (только в режиме разработки) идут параллельно
+        cleanup = [db.close(), dp.storage.close(), bot.session.close()]
+        if DEV_MODE:
+            cleanup.append(stop_docker_services())
+        await asyncio.gather(*cleanup)
+        logger.info("Bot session and database pool closed.")
 
 if __name__ == '__main__':
     try:
@@ -152,4 +246,7 @@ if __name__ == '__main__':
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot application stopped by user.")
     except Exception as e:
-        logger.error(f"Fatal error during bot execution: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"Fatal error during bot execution: {e}", exc_info=True)
+    finally:
+        # Дописываем оставшиеся в очереди записи перед выходом
+        log_listener.stop()
\ No newline at end of file